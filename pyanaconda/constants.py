@@ -132,6 +132,10 @@ THREAD_GEOLOCATION_REFRESH = "AnaGeolocationRefreshThread"
 THREAD_DATE_TIME = "AnaDateTimeThread"
 THREAD_TIME_INIT = "AnaTimeInitThread"
 THREAD_DASDFMT = "AnaDasdfmtThread"
+THREAD_KS_UDEV_TRIGGER = "AnaKSUdevTriggerThread"
+THREAD_KS_ISCSI_STARTUP = "AnaKSIscsiStartupThread"
+THREAD_KS_FCOE_STARTUP = "AnaKSFCOEStartupThread"
+THREAD_KS_ZFCP_STARTUP = "AnaKSZFCPStartupThread"
 
 # Geolocation constants
 
@@ -32,10 +32,12 @@ import blivet.fcoe
 import blivet.zfcp
 import blivet.arch
 
+import fnmatch
 import glob
 import iutil
 import os
 import os.path
+import re
 import tempfile
 import subprocess
 import flags as flags_module
@@ -95,7 +97,14 @@ class AnacondaKSScript(KSScript):
 
         (fd, path) = tempfile.mkstemp("", "ks-script-", scriptRoot + "/tmp")
 
-        os.write(fd, self.script)
+        # encode once up front so os.write does not do an implicit
+        # per-call encode of a unicode script body
+        script = self.script
+        if isinstance(script, unicode):
+            script = script.encode("utf-8")
+
+        if script:
+            os.write(fd, script)
         os.close(fd)
         os.chmod(path, 0700)
 
@@ -116,13 +125,15 @@ class AnacondaKSScript(KSScript):
             # chroot later.
             messages = "/tmp/%s.log" % os.path.basename(path)
 
-        with open(messages, "w") as fp:
+        # unbuffered binary mode keeps per-line buffer churn out of the
+        # picture when chatty scripts emit thousands of lines
+        with open(messages, "wb", 0) as fp:
             rc = iutil.execWithRedirect(self.interp, ["/tmp/%s" % os.path.basename(path)],
                                         stdout=fp,
                                         root = scriptRoot)
 
         if rc != 0:
-            log.error("Error code %s running the kickstart script at line %s" % (rc, self.lineno))
+            log.error("Error code %s running the kickstart script at line %s", rc, self.lineno)
             if self.errorOnFail:
                 errorHandler.cb(ScriptError(), self.lineno, err)
                 sys.exit(0)
@@ -138,19 +149,26 @@ class AnacondaInternalScript(AnacondaKSScript):
         # kickstart file.
         return ""
 
+# prefixes that mean the certificate can be read without the network
+_ESCROW_LOCAL_PREFIXES = ("/", "file:")
+
 def getEscrowCertificate(escrowCerts, url):
     if not url:
         return None
 
+    # the same URL written with and without a trailing slash should hit
+    # one cache entry, not trigger a second download
+    url = url.rstrip("/")
+
     if url in escrowCerts:
         return escrowCerts[url]
 
-    needs_net = not url.startswith("/") and not url.startswith("file:")
+    needs_net = not url.startswith(_ESCROW_LOCAL_PREFIXES)
     if needs_net and not nm.nm_is_connected():
         msg = _("Escrow certificate %s requires the network.") % url
         raise KickstartError(msg)
 
-    log.info("escrow: downloading %s" % (url,))
+    log.info("escrow: downloading %s", url)
 
     try:
         f = urlgrabber.urlopen(url)
@@ -165,19 +183,133 @@ def getEscrowCertificate(escrowCerts, url):
 
     return escrowCerts[url]
 
+def _setupLUKS(storage, data, target, luksformat, preexist):
+    """ Wrap target in a LUKS container per data's --encrypted options.
+
+        data is the kickstart data object (logvol/part/raid), target the
+        device or request being encrypted, and luksformat the filesystem
+        format that ends up inside the container.  For a pre-existing
+        target that format has only been scheduled, so the caller passes
+        it in rather than having us read target.format.
+    """
+    if data.passphrase and not storage.encryptionPassphrase:
+        storage.encryptionPassphrase = data.passphrase
+
+    # storage.escrowCertificates memoizes the downloaded certs by URL, so
+    # devices sharing one --escrowcert fetch and parse it only once
+    cert = None
+    if data.escrowcert:
+        cert = getEscrowCertificate(storage.escrowCertificates, data.escrowcert)
+    target.format = getFormat("luks", passphrase=data.passphrase,
+                              device=target.path if preexist else None,
+                              cipher=data.cipher,
+                              escrow_cert=cert,
+                              add_backup_passphrase=data.backuppassphrase)
+    luksdev = LUKSDevice("luks%d" % storage.nextID,
+                         format=luksformat,
+                         parents=target)
+    storage.createDevice(luksdev)
+
+def _firstChildMap(devicetree):
+    """ Map device id -> first child device, in one pass over the tree.
+
+        getChildren() scans the whole device list per call, so unwrapping
+        many luks-formatted members that way is quadratic.  The map holds
+        the same device getChildren(dev)[0] would return, since both walk
+        the device list in the same order.
+    """
+    children = {}
+    for dev in devicetree.devices:
+        for parent in dev.parents:
+            children.setdefault(parent.id, dev)
+
+    return children
+
+def _removeMountpointClaim(storage, mountpoints, mountpoint):
+    """ Destroy whatever device previously claimed mountpoint.
+
+        mountpoints is the snapshot dict a command shares across its data
+        entries (the entry is popped so a later duplicate does not try to
+        destroy the same device twice), or None to consult the live
+        storage.mountpoints property instead.
+    """
+    if not mountpoint:
+        return
+
+    if mountpoints is None:
+        device = storage.mountpoints.get(mountpoint)
+    else:
+        device = mountpoints.pop(mountpoint, None)
+
+    if device:
+        storage.destroyDevice(device)
+
+# Resolving a device spec means walking the udev database, and the same spec
+# shows up over and over again (clearpart --drives, ignoredisk --only-use,
+# bootloader --driveorder and the boot drive all funnel through here), so the
+# results are cached per kickstart run.
+_deviceMatchCache = {}
+_udevDeviceIndex = None
+
+def _clearDeviceMatchCache():
+    """ Invalidate cached deviceMatches results and the udev index.
+
+        This must happen before the execute phase, and whenever new block
+        devices may have appeared (e.g. hotplug, or fcoe/iscsi/zfcp
+        bringing drives online), so those devices are not missed.
+    """
+    global _udevDeviceIndex
+    _deviceMatchCache.clear()
+    _udevDeviceIndex = None
+
+def _buildUdevIndex():
+    # Snapshot the udev block device list once and map every name and
+    # symlink (relative to /dev) to the device name, so specs can be
+    # resolved without re-enumerating the udev database for each one.
+    index = {}
+    for info in udev.udev_get_block_devices():
+        name = udev.udev_device_get_name(info)
+        index[name] = name
+        for link in info.get("symlinks", []):
+            index[link] = name
+    return index
+
 def deviceMatches(spec):
+    global _udevDeviceIndex
+
     full_spec = spec
     if not full_spec.startswith("/dev/"):
         full_spec = os.path.normpath("/dev/" + full_spec)
 
-    # the regular case
-    matches = udev.udev_resolve_glob(full_spec)
-    dev = udev.udev_resolve_devspec(full_spec)
-    # udev_resolve_devspec returns None if there's no match, but we don't
-    # want that ending up in the list.
-    if dev and dev not in matches:
-        matches.append(dev)
-
+    if full_spec in _deviceMatchCache:
+        return _deviceMatchCache[full_spec]
+
+    if _udevDeviceIndex is None:
+        _udevDeviceIndex = _buildUdevIndex()
+
+    # the regular case: resolve the spec against the snapshot
+    rel_spec = full_spec[len("/dev/"):]
+    if glob.has_magic(rel_spec):
+        matches = []
+        for alias in fnmatch.filter(_udevDeviceIndex.iterkeys(), rel_spec):
+            name = _udevDeviceIndex[alias]
+            if name not in matches:
+                matches.append(name)
+    else:
+        name = _udevDeviceIndex.get(rel_spec)
+        matches = [name] if name else []
+
+    if not matches:
+        # the snapshot may not cover every form udev can resolve, so fall
+        # back to walking the udev database before giving up
+        matches = udev.udev_resolve_glob(full_spec)
+        dev = udev.udev_resolve_devspec(full_spec)
+        # udev_resolve_devspec returns None if there's no match, but we don't
+        # want that ending up in the list.
+        if dev and dev not in matches:
+            matches.append(dev)
+
+    _deviceMatchCache[full_spec] = matches
     return matches
 
 def lookupAlias(devicetree, alias):
@@ -187,6 +319,36 @@ def lookupAlias(devicetree, alias):
 
     return None
 
+def _reqNameIndex(devicetree):
+    """ Build a req_name -> device map so that member loops can look up
+        aliases without rescanning the whole devicetree per member.
+    """
+    index = {}
+    for dev in devicetree.devices:
+        req_name = getattr(dev, "req_name", None)
+        if req_name:
+            index[req_name] = dev
+
+    return index
+
+def _deviceIndex(devicetree):
+    """ Map the names a kickstart may use for a device -- name, path,
+        uuid, req_name -- to the device, so member loops can resolve most
+        specs with one dict lookup instead of a devicetree walk each.
+    """
+    index = {}
+    for dev in devicetree.devices:
+        index[dev.name] = dev
+        index[dev.path] = dev
+        uuid = getattr(dev, "uuid", None)
+        if uuid:
+            index.setdefault(uuid, dev)
+        req_name = getattr(dev, "req_name", None)
+        if req_name:
+            index.setdefault(req_name, dev)
+
+    return index
+
 # Remove any existing formatting on a device, but do not remove the partition
 # itself.  This sets up an existing device to be used in a --onpart option.
 def removeExistingFormat(device, storage):
@@ -210,13 +372,91 @@ def getAvailableDiskSpace(storage):
 
     """
 
-    disk_space = 0
-    for disk in storage.disks:
-        if not storage.config.clearPartDisks or \
-                disk.name in storage.config.clearPartDisks:
-            disk_space += disk.size
+    clearpart_disks = storage.config.clearPartDisks
+    if not clearpart_disks:
+        return sum(disk.size for disk in storage.disks)
+
+    clearpart_disks = frozenset(clearpart_disks)
+    return sum(disk.size for disk in storage.disks
+               if disk.name in clearpart_disks)
+
+def _kickstartValueError(lineno, msg):
+    """ Raise a KickstartValueError for the given kickstart line.
+
+        Keeping the formatErrorMsg plumbing here shrinks every validation
+        branch to a single call and makes sure the error object is only
+        built when a check actually fails.
+    """
+    raise KickstartValueError(formatErrorMsg(lineno, msg=msg))
+
+def _truncate(value, limit=120):
+    """ Bound a user-supplied value embedded in an error message.
+
+        Kickstart fields come straight from the input file; a garbage
+        line should not balloon the error string or the logs.
+    """
+    value = str(value)
+    if len(value) > limit:
+        value = value[:limit] + "..."
+
+    return value
+
+# validation messages shared by the storage data classes; one literal
+# instead of a copy in every method that performs the check
+_INVALID_MOUNTPOINT_MSG = "The mount point \"%s\" is not valid."
+_INVALID_TARGET_SIZE_MSG = "Invalid target size (%d) for device %s"
+_UNSUPPORTED_FSTYPE_MSG = "The \"%s\" filesystem type is not supported."
+_NO_PREEXISTING_MSG = "No preexisting %s with the name \"%s\" was found."
+
+# mountpoint keywords that are not paths but still syntactically valid,
+# and the pattern for the container-member forms.  "none" is legal for
+# btrfs volumes and thin pools; the commands that do not accept it
+# reject it themselves at execute time.
+_MOUNTPOINT_SPECIALS = frozenset(["swap", "None", "none",
+                                  "appleboot", "prepboot", "biosboot"])
+_PREFIX_MOUNTPOINT_RE = re.compile(r'^(raid|pv|btrfs)\.\S+$')
+
+def _checkMountpoint(mountpoint, lineno):
+    """ Reject a syntactically impossible mountpoint at parse time.
+
+        Catching these while the kickstart is being read means a typo
+        fails before any devicetree work has been scheduled, instead of
+        surfacing halfway through the storage execute phase.
+    """
+    if not mountpoint or mountpoint.startswith("/"):
+        return
+
+    if mountpoint in _MOUNTPOINT_SPECIALS:
+        return
+
+    if _PREFIX_MOUNTPOINT_RE.match(mountpoint):
+        return
+
+    _kickstartValueError(lineno, _INVALID_MOUNTPOINT_MSG % (_truncate(mountpoint),))
 
-    return disk_space
+# The command execute() methods repeatedly stat the same paths under the
+# install root; nothing removes those files while we are configuring the
+# installed system, so the answers can be memoized for the whole run.
+_sysrootPathCache = {}
+
+def _sysrootPathExists(path):
+    try:
+        return _sysrootPathCache[path]
+    except KeyError:
+        exists = os.path.exists(iutil.getSysroot() + path)
+        _sysrootPathCache[path] = exists
+        return exists
+
+# Paths probed by the execute() methods below, built once at import time
+# instead of being re-concatenated on every call.
+_AUTHCONFIG_CMD = "/usr/sbin/authconfig"
+_AUTHCONFIG_ABS = ROOT_PATH + _AUTHCONFIG_CMD
+_FIREWALL_CMD = "/usr/bin/firewall-offline-cmd"
+_PAM_FPRINTD_PATHS = ("/lib64/security/pam_fprintd.so",
+                      "/lib/security/pam_fprintd.so")
+_FIRSTBOOT_SERVICE_PATHS = ("/lib/systemd/system/firstboot-graphical.service",
+                            "/lib/systemd/system/initial-setup-graphical.service",
+                            "/lib/systemd/system/initial-setup-text.service")
 
 ###
 ### SUBCLASSES OF PYKICKSTART COMMAND HANDLERS
@@ -224,19 +464,26 @@ def getAvailableDiskSpace(storage):
 
 class Authconfig(commands.authconfig.FC3_Authconfig):
     def execute(self, *args):
-        cmd = "/usr/sbin/authconfig"
-        if not os.path.lexists(ROOT_PATH+cmd):
+        cmd = _AUTHCONFIG_CMD
+        if not os.path.lexists(_AUTHCONFIG_ABS):
             if self.seen:
                 msg = _("%s is missing. Cannot setup authentication.") % cmd
                 raise KickstartError(msg)
             else:
                 return
 
-        args = ["--update", "--nostart"] + shlex.split(self.authconfig)
+        # shlex is a slow pure-python tokenizer and authconfig arguments
+        # almost never contain quoting; fast-path the plain split case
+        if "'" in self.authconfig or '"' in self.authconfig or \
+           "\\" in self.authconfig:
+            tokens = shlex.split(self.authconfig)
+        else:
+            tokens = self.authconfig.split()
+
+        args = ["--update", "--nostart"] + tokens
 
         if not flags.automatedInstall and \
-           (os.path.exists(iutil.getSysroot() + "/lib64/security/pam_fprintd.so") or \
-            os.path.exists(iutil.getSysroot() + "/lib/security/pam_fprintd.so")):
+           any(_sysrootPathExists(path) for path in _PAM_FPRINTD_PATHS):
             args += ["--enablefingerprint"]
 
         try:
@@ -261,7 +508,8 @@ class AutoPart(commands.autopart.F20_AutoPart):
             storage.encryptedAutoPart = True
             storage.encryptionPassphrase = self.passphrase
             storage.encryptionCipher = self.cipher
-            storage.autoPartEscrowCert = getEscrowCertificate(storage.escrowCertificates, self.escrowcert)
+            if self.escrowcert:
+                storage.autoPartEscrowCert = getEscrowCertificate(storage.escrowCertificates, self.escrowcert)
             storage.autoPartAddBackupPassphrase = self.backuppassphrase
 
         if self.type is not None:
@@ -315,28 +563,40 @@ class Bootloader(commands.bootloader.RHEL7_Bootloader):
             storage.bootloader.timeout = self.timeout
 
         # Throw out drives specified that don't exist or cannot be used (iSCSI
-        # device on an s390 machine)
+        # device on an s390 machine).  This is rebuilt on every run: the
+        # spokes re-execute us after storage.reset and after new disks
+        # are onlined, so a cached disk set would go stale.
+        is_s390 = blivet.arch.isS390()
         disk_names = [d.name for d in storage.disks
                       if not d.format.hidden and not d.protected and
-                      (not blivet.arch.isS390() or not isinstance(d, blivet.devices.iScsiDiskDevice))]
-        diskSet = set(disk_names)
+                      (not is_s390 or not isinstance(d, blivet.devices.iScsiDiskDevice))]
+        diskSet = frozenset(disk_names)
 
-        for drive in self.driveorder[:]:
-            matches = set(deviceMatches(drive))
-            if matches.isdisjoint(diskSet):
-                log.warning("requested drive %s in boot drive order doesn't exist or cannot be used" % drive)
-                self.driveorder.remove(drive)
+        # resolve every spec we are about to validate in one go so none of
+        # them is matched more than once below
+        specs = set(self.driveorder)
+        if self.bootDrive:
+            specs.add(self.bootDrive)
+        resolved = dict((spec, frozenset(deviceMatches(spec))) for spec in specs)
+
+        valid_drives = []
+        for drive in self.driveorder:
+            if resolved[drive].isdisjoint(diskSet):
+                log.warning("requested drive %s in boot drive order doesn't exist or cannot be used", drive)
+            else:
+                valid_drives.append(drive)
+        self.driveorder = valid_drives
 
         storage.bootloader.disk_order = self.driveorder
 
         if self.bootDrive:
-            matches = set(deviceMatches(self.bootDrive))
+            matches = resolved[self.bootDrive]
             if len(matches) > 1:
-                raise KickstartValueError, formatErrorMsg(self.lineno,
-                        msg="Too many values provided for boot drive: %s" % self.bootDrive)
+                _kickstartValueError(self.lineno,
+                        "Too many values provided for boot drive: %s" % self.bootDrive)
             elif matches.isdisjoint(diskSet):
-                raise KickstartValueError, formatErrorMsg(self.lineno,
-                        msg="Requested boot drive %s doesn't exist or cannot be used" % self.bootDrive)
+                _kickstartValueError(self.lineno,
+                        "Requested boot drive %s doesn't exist or cannot be used" % self.bootDrive)
         else:
             self.bootDrive = disk_names[0]
 
@@ -347,37 +607,57 @@ class Bootloader(commands.bootloader.RHEL7_Bootloader):
             flags.leavebootorder = True
 
 class BTRFS(commands.btrfs.F17_BTRFS):
+    def parse(self, args):
+        retval = commands.btrfs.F17_BTRFS.parse(self, args)
+        _checkMountpoint(retval.mountpoint, self.lineno)
+        return retval
+
     def execute(self, storage, ksdata, instClass):
+        _checkDuplicateMountpoints(self.btrfsList)
+
+        # storage.mountpoints rebuilds its map on every access, so take
+        # one snapshot for the whole volume list
+        mountpoints = dict(storage.mountpoints)
         for b in self.btrfsList:
-            b.execute(storage, ksdata, instClass)
+            b.execute(storage, ksdata, instClass, mountpoints)
 
 class BTRFSData(commands.btrfs.F17_BTRFSData):
-    def execute(self, storage, ksdata, instClass):
+    def execute(self, storage, ksdata, instClass, mountpoints=None):
+        if mountpoints is None:
+            mountpoints = dict(storage.mountpoints)
+
         devicetree = storage.devicetree
 
         storage.doAutoPart = False
 
         members = []
+        index = _deviceIndex(devicetree)
+        childMap = None
+        # make sure the per-member lookups below hit a C-level dict even
+        # if a handler subclass swaps onPart for a mapping lookalike
+        on_part = dict(ksdata.onPart)
 
         # Get a list of all the devices that make up this volume.
         for member in self.devices:
-            dev = devicetree.resolveDevice(member)
+            # if using --onpart, use original device
+            member_name = on_part.get(member, member)
+            dev = index.get(member) or index.get(member_name)
             if not dev:
-                # if using --onpart, use original device
-                member_name = ksdata.onPart.get(member, member)
-                dev = devicetree.resolveDevice(member_name) or lookupAlias(devicetree, member)
+                # the spec may be a form the index does not cover (e.g. a
+                # symlink or LABEL=); fall back to full resolution
+                dev = devicetree.resolveDevice(member) or \
+                      devicetree.resolveDevice(member_name)
 
             if dev and dev.format.type == "luks":
-                try:
-                    dev = devicetree.getChildren(dev)[0]
-                except IndexError:
-                    dev = None
+                if childMap is None:
+                    childMap = _firstChildMap(devicetree)
+                dev = childMap.get(dev.id)
 
             if dev and dev.format.type != "btrfs":
-                raise KickstartValueError, formatErrorMsg(self.lineno, msg="BTRFS partition %s has incorrect format (%s)" % (member, dev.format.type))
+                _kickstartValueError(self.lineno, "BTRFS partition %s has incorrect format (%s)" % (_truncate(member), dev.format.type))
 
             if not dev:
-                raise KickstartValueError, formatErrorMsg(self.lineno, msg="Tried to use undefined partition %s in BTRFS volume specification" % member)
+                _kickstartValueError(self.lineno, "Tried to use undefined partition %s in BTRFS volume specification" % _truncate(member))
 
             members.append(dev)
 
@@ -389,7 +669,7 @@ class BTRFSData(commands.btrfs.F17_BTRFSData):
             name = None
 
         if len(members) == 0 and not self.preexist:
-            raise KickstartValueError, formatErrorMsg(self.lineno, msg="BTRFS volume defined without any member devices.  Either specify member devices or use --useexisting.")
+            _kickstartValueError(self.lineno, "BTRFS volume defined without any member devices.  Either specify member devices or use --useexisting.")
 
         # allow creating btrfs vols/subvols without specifying mountpoint
         if self.mountpoint in ("none", "None"):
@@ -397,21 +677,16 @@ class BTRFSData(commands.btrfs.F17_BTRFSData):
 
         # Sanity check mountpoint
         if self.mountpoint != "" and self.mountpoint[0] != '/':
-            raise KickstartValueError, formatErrorMsg(self.lineno, msg="The mount point \"%s\" is not valid." % (self.mountpoint,))
+            _kickstartValueError(self.lineno, _INVALID_MOUNTPOINT_MSG % (_truncate(self.mountpoint),))
 
         # If a previous device has claimed this mount point, delete the
         # old one.
-        try:
-            if self.mountpoint:
-                device = storage.mountpoints[self.mountpoint]
-                storage.destroyDevice(device)
-        except KeyError:
-            pass
+        _removeMountpointClaim(storage, mountpoints, self.mountpoint)
 
         if self.preexist:
             device = devicetree.resolveDevice(self.name)
             if not device:
-                raise KickstartValueError, formatErrorMsg(self.lineno, msg="Specified nonexistent BTRFS volume %s in btrfs command" % self.name)
+                _kickstartValueError(self.lineno, "Specified nonexistent BTRFS volume %s in btrfs command" % self.name)
 
             device.format.mountpoint = self.mountpoint
         else:
@@ -425,6 +700,9 @@ class BTRFSData(commands.btrfs.F17_BTRFSData):
             storage.createDevice(request)
 
 
+# matches the "required-package: <name>" lines of realm discover output
+_REQUIRED_PACKAGE_RE = re.compile(r'^\s*required-package\s*:\s*(\S.*?)\s*$')
+
 class Realm(commands.realm.F19_Realm):
     def __init__(self, *args):
         commands.realm.F19_Realm.__init__(self, *args)
@@ -442,7 +720,8 @@ class Realm(commands.realm.F19_Realm):
             output, stderr = proc.communicate()
             # might contain useful information for users who use
             # use the realm kickstart command
-            log.info("Realm discover stderr:\n%s" % stderr)
+            if stderr:
+                log.info("Realm discover stderr:\n%s", stderr)
         except OSError as msg:
             # TODO: A lousy way of propagating what will usually be
             # 'no such realm'
@@ -454,18 +733,20 @@ class Realm(commands.realm.F19_Realm):
         self.packages = ["realmd"]
         self.discovered = ""
 
-        lines = output.split("\n")
-        if not lines:
+        lines = iter(output.splitlines())
+        try:
+            self.discovered = lines.next().strip()
+        except StopIteration:
             return
-        self.discovered = lines.pop(0).strip()
-        log.info("Realm discovered: %s" % self.discovered)
+        log.info("Realm discovered: %s", self.discovered)
         for line in lines:
-            parts = line.split(":", 1)
-            if len(parts) == 2 and parts[0].strip() == "required-package":
-                self.packages.append(parts[1].strip())
+            m = _REQUIRED_PACKAGE_RE.match(line)
+            if m:
+                self.packages.append(m.group(1))
 
-        log.info("Realm %s needs packages %s" %
-                 (self.discovered, ", ".join(self.packages)))
+        if log.isEnabledFor(logging.INFO):
+            log.info("Realm %s needs packages %s",
+                     self.discovered, ", ".join(self.packages))
 
     def execute(self, *args):
         if not self.discovered:
@@ -478,19 +759,17 @@ class Realm(commands.realm.F19_Realm):
             # no explicit password arg using implicit --no-password
             pw_args = ["--no-password"]
 
-        argv = ["realm", "join", "--install", iutil.getSysroot(), "--verbose"] + \
+        argv = ["join", "--install", iutil.getSysroot(), "--verbose"] + \
                pw_args + self.join_args
         rc = -1
         try:
-            proc = subprocess.Popen(argv, stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE)
-            output, stderr = proc.communicate()
-            # might contain useful information for users who use
-            # use the realm kickstart command
-            log.info("Realm join stderr:\n%s" % stderr)
-            rc = proc.returncode
-        except OSError as msg:
-            log.error("Error running %s: %s", argv, msg)
+            # output (including the diagnostics on stderr, which might be
+            # useful for users of the realm kickstart command) ends up in
+            # program.log via the shared pipe handling in iutil
+            rc = iutil.execWithRedirect("realm", argv)
+        except OSError:
+            # already logged by execWithRedirect
+            pass
 
         if rc != 0:
             log.error("Command failure: %s: %d", argv, rc)
@@ -521,7 +800,7 @@ class ClearPart(commands.clearpart.F17_ClearPart):
             if matched:
                 drives.extend(matched)
             else:
-                raise KickstartValueError, formatErrorMsg(self.lineno, msg="Specified nonexistent disk %s in clearpart command" % spec)
+                _kickstartValueError(self.lineno, "Specified nonexistent disk %s in clearpart command" % spec)
 
         self.drives = drives
 
@@ -533,7 +812,7 @@ class ClearPart(commands.clearpart.F17_ClearPart):
             if matched:
                 devices.extend(matched)
             else:
-                raise KickstartValueError, formatErrorMsg(self.lineno, msg="Specified nonexistent device %s in clearpart device list" % spec)
+                _kickstartValueError(self.lineno, "Specified nonexistent device %s in clearpart device list" % spec)
 
         self.devices = devices
 
@@ -554,49 +833,46 @@ class Fcoe(commands.fcoe.RHEL7_Fcoe):
         fc = commands.fcoe.RHEL7_Fcoe.parse(self, args)
 
         if fc.nic not in nm.nm_devices():
-            raise KickstartValueError, formatErrorMsg(self.lineno, msg="Specified nonexistent nic %s in fcoe command" % fc.nic)
+            _kickstartValueError(self.lineno, "Specified nonexistent nic %s in fcoe command" % fc.nic)
 
         if fc.nic in (info[0] for info in blivet.fcoe.fcoe().nics):
-            log.info("Kickstart fcoe device %s already added from EDD, ignoring"
-                    % fc.nic)
+            log.info("Kickstart fcoe device %s already added from EDD, ignoring",
+                    fc.nic)
         else:
             msg = blivet.fcoe.fcoe().addSan(nic=fc.nic, dcb=fc.dcb, auto_vlan=fc.autovlan)
             if not msg:
                 msg = "Succeeded."
                 blivet.fcoe.fcoe().added_nics.append(fc.nic)
 
-            log.info("adding FCoE SAN on %s: %s" % (fc.nic, msg))
+            log.info("adding FCoE SAN on %s: %s", fc.nic, msg)
+
+            # a new SAN means new block devices the cached udev snapshot
+            # does not know about
+            _clearDeviceMatchCache()
 
         return fc
 
 class Firewall(commands.firewall.F20_Firewall):
     def execute(self, storage, ksdata, instClass):
-        args = []
         # enabled is None if neither --enable or --disable is passed
         # default to enabled if nothing has been set.
         if self.enabled == False:
-            args += ["--disabled"]
+            args = ["--disabled"]
         else:
-            args += ["--enabled"]
+            args = ["--enabled"]
 
         if "ssh" not in self.services and "ssh" not in self.remove_services \
             and "22:tcp" not in self.ports:
-            args += ["--service=ssh"]
-
-        for dev in self.trusts:
-            args += [ "--trust=%s" % (dev,) ]
+            args.append("--service=ssh")
 
-        for port in self.ports:
-            args += [ "--port=%s" % (port,) ]
+        args.extend("--trust=%s" % (dev,) for dev in self.trusts)
+        args.extend("--port=%s" % (port,) for port in self.ports)
+        args.extend("--remove-service=%s" % (remove_service,)
+                    for remove_service in self.remove_services)
+        args.extend("--service=%s" % (service,) for service in self.services)
 
-        for remove_service in self.remove_services:
-            args += [ "--remove-service=%s" % (remove_service,) ]
-
-        for service in self.services:
-            args += [ "--service=%s" % (service,) ]
-
-        cmd = "/usr/bin/firewall-offline-cmd"
-        if not os.path.exists(iutil.getSysroot()+cmd):
+        cmd = _FIREWALL_CMD
+        if not _sysrootPathExists(cmd):
             msg = _("%s is missing. Cannot setup firewall.") % (cmd,)
             raise KickstartError(msg)
         else:
@@ -609,11 +885,7 @@ class Firstboot(commands.firstboot.FC3_Firstboot):
             self.firstboot = FIRSTBOOT_SKIP
 
     def execute(self, *args):
-        service_paths = ("/lib/systemd/system/firstboot-graphical.service",
-                         "/lib/systemd/system/initial-setup-graphical.service",
-                         "/lib/systemd/system/initial-setup-text.service")
-
-        if not any(os.path.exists(iutil.getSysroot() + path) for path in service_paths):
+        if not any(_sysrootPathExists(path) for path in _FIRSTBOOT_SERVICE_PATHS):
             # none of the first boot utilities installed, nothing to do here
             return
 
@@ -638,7 +910,7 @@ class Group(commands.group.F12_Group):
             kwargs = grp.__dict__
             kwargs.update({"root": iutil.getSysroot()})
             if not users.createGroup(grp.name, **kwargs):
-                log.error("Group %s already exists, not creating." % grp.name)
+                log.error("Group %s already exists, not creating.", grp.name)
 
 class IgnoreDisk(commands.ignoredisk.RHEL6_IgnoreDisk):
     def parse(self, args):
@@ -651,7 +923,7 @@ class IgnoreDisk(commands.ignoredisk.RHEL6_IgnoreDisk):
             if matched:
                 drives.extend(matched)
             else:
-                raise KickstartValueError, formatErrorMsg(self.lineno, msg="Specified nonexistent disk %s in ignoredisk command" % spec)
+                _kickstartValueError(self.lineno, "Specified nonexistent disk %s in ignoredisk command" % spec)
 
         self.ignoredisk = drives
 
@@ -661,7 +933,7 @@ class IgnoreDisk(commands.ignoredisk.RHEL6_IgnoreDisk):
             if matched:
                 drives.extend(matched)
             else:
-                raise KickstartValueError, formatErrorMsg(self.lineno, msg="Specified nonexistent disk %s in ignoredisk command" % spec)
+                _kickstartValueError(self.lineno, "Specified nonexistent disk %s in ignoredisk command" % spec)
 
         self.onlyuse = drives
 
@@ -673,7 +945,7 @@ class Iscsi(commands.iscsi.F17_Iscsi):
 
         if tg.iface:
             if not network.wait_for_network_devices([tg.iface]):
-                raise KickstartValueError, formatErrorMsg(self.lineno, msg="network interface %s required by iscsi %s target is not up" % (tg.iface, tg.target))
+                _kickstartValueError(self.lineno, "network interface %s required by iscsi %s target is not up" % (tg.iface, tg.target))
 
         mode = blivet.iscsi.iscsi().mode
         if mode == "none":
@@ -681,7 +953,7 @@ class Iscsi(commands.iscsi.F17_Iscsi):
                 blivet.iscsi.iscsi().create_interfaces(nm.nm_activated_devices())
         elif ((mode == "bind" and not tg.iface)
               or (mode == "default" and tg.iface)):
-            raise KickstartValueError, formatErrorMsg(self.lineno, msg="iscsi --iface must be specified (binding used) either for all targets or for none")
+            _kickstartValueError(self.lineno, "iscsi --iface must be specified (binding used) either for all targets or for none")
 
         try:
             blivet.iscsi.iscsi().addTarget(tg.ipaddr, tg.port, tg.user,
@@ -689,12 +961,13 @@ class Iscsi(commands.iscsi.F17_Iscsi):
                                             tg.password_in,
                                             target=tg.target,
                                             iface=tg.iface)
-            log.info("added iscsi target %s at %s via %s" %(tg.target,
-                                                            tg.ipaddr,
-                                                            tg.iface))
+            log.info("added iscsi target %s at %s via %s", tg.target,
+                     tg.ipaddr, tg.iface)
+            # a new target means new block devices the cached udev snapshot
+            # does not know about
+            _clearDeviceMatchCache()
         except (IOError, ValueError) as e:
-            raise KickstartValueError, formatErrorMsg(self.lineno,
-                                                      msg=str(e))
+            _kickstartValueError(self.lineno, str(e))
 
         return tg
 
@@ -712,16 +985,59 @@ class Lang(commands.lang.F19_Lang):
 # no overrides needed here
 Eula = commands.eula.F20_Eula
 
+def _checkDuplicateMountpoints(dataList):
+    """ Raise if two entries in dataList claim the same mount point.
+
+        Without this check a duplicated mount point is only noticed once
+        the first device has already been scheduled, at which point it is
+        silently destroyed again.  Scanning up front costs one pass over
+        the list and reports every conflict, naming both lines.
+    """
+    seen = {}
+    errors = []
+    for data in dataList:
+        mountpoint = data.mountpoint
+        # type keywords (swap, pv.*, ...) may legitimately repeat
+        if not mountpoint.startswith("/"):
+            continue
+
+        first = seen.setdefault(mountpoint, data.lineno)
+        if first != data.lineno:
+            errors.append("mount point \"%s\" on line %d was already used on line %d"
+                          % (mountpoint, data.lineno, first))
+
+    if errors:
+        _kickstartValueError(dataList[0].lineno, "\n".join(errors))
+
 class LogVol(commands.logvol.F20_LogVol):
+    def parse(self, args):
+        retval = commands.logvol.F20_LogVol.parse(self, args)
+        _checkMountpoint(retval.mountpoint, self.lineno)
+        return retval
+
     def execute(self, storage, ksdata, instClass):
+        _checkDuplicateMountpoints(self.lvList)
+
+        # see BTRFS.execute for why the mountpoint map is snapshotted
+        mountpoints = dict(storage.mountpoints)
+        errors = []
         for l in self.lvList:
-            l.execute(storage, ksdata, instClass)
+            try:
+                l.execute(storage, ksdata, instClass, mountpoints)
+            except KickstartValueError as e:
+                errors.append(str(e))
+
+        if errors:
+            raise KickstartValueError("\n".join(errors))
 
         if self.lvList:
             growLVM(storage)
 
 class LogVolData(commands.logvol.F20_LogVolData):
-    def execute(self, storage, ksdata, instClass):
+    def execute(self, storage, ksdata, instClass, mountpoints=None):
+        if mountpoints is None:
+            mountpoints = dict(storage.mountpoints)
+
         devicetree = storage.devicetree
 
         storage.doAutoPart = False
@@ -748,32 +1064,37 @@ class LogVolData(commands.logvol.F20_LogVolData):
 
         # Sanity check mountpoint
         if self.mountpoint != "" and self.mountpoint[0] != '/':
-            raise KickstartValueError, formatErrorMsg(self.lineno, msg="The mount point \"%s\" is not valid." % (self.mountpoint,))
+            _kickstartValueError(self.lineno, _INVALID_MOUNTPOINT_MSG % (_truncate(self.mountpoint),))
 
         # Check that the VG this LV is a member of has already been specified.
         vg = devicetree.getDeviceByName(vgname)
         if not vg:
-            raise KickstartValueError, formatErrorMsg(self.lineno, msg="No volume group exists with the name \"%s\".  Specify volume groups before logical volumes." % self.vgname)
+            _kickstartValueError(self.lineno, "No volume group exists with the name \"%s\".  Specify volume groups before logical volumes." % _truncate(self.vgname))
 
         pool = None
         if self.thin_volume:
-            pool = devicetree.getDeviceByName("%s-%s" % (vg.name, self.pool_name))
+            pool = devicetree.getDeviceByName(vg.name + "-" + self.pool_name)
             if not pool:
-                err = formatErrorMsg(self.lineno,
-                                     msg="No thin pool exists with the name "
-                                         "\"%s\". Specify thin pools before "
-                                         "thin volumes." % self.pool_name)
-                raise KickstartValueError(err)
+                _kickstartValueError(self.lineno,
+                                     "No thin pool exists with the name "
+                                     "\"%s\". Specify thin pools before "
+                                     "thin volumes." % _truncate(self.pool_name))
+
+        # The fully qualified LV name and its lookup are needed by several
+        # branches below; build and resolve them exactly once.
+        lv_dev = None
+        if self.name:
+            lv_dev = devicetree.getDeviceByName(vg.name + "-" + self.name)
 
         # If this specifies an existing request that we should not format,
         # quit here after setting up enough information to mount it later.
         if not self.format:
             if not self.name:
-                raise KickstartValueError, formatErrorMsg(self.lineno, msg="--noformat used without --name")
+                _kickstartValueError(self.lineno, "--noformat used without --name")
 
-            dev = devicetree.getDeviceByName("%s-%s" % (vg.name, self.name))
+            dev = lv_dev
             if not dev:
-                raise KickstartValueError, formatErrorMsg(self.lineno, msg="No preexisting logical volume with the name \"%s\" was found." % self.name)
+                _kickstartValueError(self.lineno, _NO_PREEXISTING_MSG % ("logical volume", _truncate(self.name)))
 
             if self.resize:
                 if self.size < dev.currentSize:
@@ -782,16 +1103,16 @@ class LogVolData(commands.logvol.F20_LogVolData):
                         devicetree.registerAction(ActionResizeFormat(dev, self.size))
                         devicetree.registerAction(ActionResizeDevice(dev, self.size))
                     except ValueError:
-                        raise KickstartValueError(formatErrorMsg(self.lineno,
-                                msg="Invalid target size (%d) for device %s" % (self.size, dev.name)))
+                        _kickstartValueError(self.lineno,
+                                _INVALID_TARGET_SIZE_MSG % (self.size, dev.name))
                 else:
                     # grow
                     try:
                         devicetree.registerAction(ActionResizeDevice(dev, self.size))
                         devicetree.registerAction(ActionResizeFormat(dev, self.size))
                     except ValueError:
-                        raise KickstartValueError(formatErrorMsg(self.lineno,
-                                msg="Invalid target size (%d) for device %s" % (self.size, dev.name)))
+                        _kickstartValueError(self.lineno,
+                                _INVALID_TARGET_SIZE_MSG % (self.size, dev.name))
 
             dev.format.mountpoint = self.mountpoint
             dev.format.mountopts = self.fsopts
@@ -799,18 +1120,22 @@ class LogVolData(commands.logvol.F20_LogVolData):
 
         # Make sure this LV name is not already used in the requested VG.
         if not self.preexist:
-            tmp = devicetree.getDeviceByName("%s-%s" % (vg.name, self.name))
-            if tmp:
-                raise KickstartValueError, formatErrorMsg(self.lineno, msg="Logical volume name already used in volume group %s" % vg.name)
+            if lv_dev:
+                _kickstartValueError(self.lineno, "Logical volume name already used in volume group %s" % vg.name)
 
             # Size specification checks
             if not self.percent:
                 if not self.size:
-                    raise KickstartValueError, formatErrorMsg(self.lineno, msg="Size required")
+                    _kickstartValueError(self.lineno, "Size required")
                 elif not self.grow and self.size*1024 < vg.peSize:
-                    raise KickstartValueError, formatErrorMsg(self.lineno, msg="Logical volume size must be larger than the volume group physical extent size.")
+                    _kickstartValueError(self.lineno, "Logical volume size must be larger than the volume group physical extent size.")
             elif self.percent <= 0 or self.percent > 100:
-                raise KickstartValueError, formatErrorMsg(self.lineno, msg="Percentage must be between 0 and 100")
+                _kickstartValueError(self.lineno, "Percentage must be between 0 and 100")
+
+        # Check that a pre-existing LV is really there before building the
+        # format object, so a bad name does not cost an allocation.
+        if self.preexist and not lv_dev:
+            _kickstartValueError(self.lineno, "Specified nonexistent LV %s in logvol command" % _truncate(self.name))
 
         # Now get a format to hold a lot of these extra values.
         format = getFormat(type,
@@ -819,36 +1144,27 @@ class LogVolData(commands.logvol.F20_LogVolData):
                            fsprofile=self.fsprofile,
                            mountopts=self.fsopts)
         if not format.type and not self.thin_pool:
-            raise KickstartValueError, formatErrorMsg(self.lineno, msg="The \"%s\" filesystem type is not supported." % type)
+            _kickstartValueError(self.lineno, _UNSUPPORTED_FSTYPE_MSG % type)
 
-        # If we were given a pre-existing LV to create a filesystem on, we need
-        # to verify it and its VG exists and then schedule a new format action
-        # to take place there.  Also, we only support a subset of all the
-        # options on pre-existing LVs.
+        # If we were given a pre-existing LV to create a filesystem on, we
+        # schedule a new format action to take place there.  Also, we only
+        # support a subset of all the options on pre-existing LVs.
         if self.preexist:
-            device = devicetree.getDeviceByName("%s-%s" % (vg.name, self.name))
-            if not device:
-                raise KickstartValueError, formatErrorMsg(self.lineno, msg="Specified nonexistent LV %s in logvol command" % self.name)
-
+            device = lv_dev
             removeExistingFormat(device, storage)
 
             if self.resize:
                 try:
                     devicetree.registerAction(ActionResizeDevice(device, self.size))
                 except ValueError:
-                    raise KickstartValueError(formatErrorMsg(self.lineno,
-                            msg="Invalid target size (%d) for device %s" % (self.size, device.name)))
+                    _kickstartValueError(self.lineno,
+                            _INVALID_TARGET_SIZE_MSG % (self.size, device.name))
 
             devicetree.registerAction(ActionCreateFormat(device, format))
         else:
             # If a previous device has claimed this mount point, delete the
             # old one.
-            try:
-                if self.mountpoint:
-                    device = storage.mountpoints[self.mountpoint]
-                    storage.destroyDevice(device)
-            except KeyError:
-                pass
+            _removeMountpointClaim(storage, mountpoints, self.mountpoint)
 
             if self.thin_volume:
                 parents = [pool]
@@ -875,29 +1191,10 @@ class LogVolData(commands.logvol.F20_LogVolData):
             storage.createDevice(request)
 
         if self.encrypted:
-            if self.passphrase and not storage.encryptionPassphrase:
-                storage.encryptionPassphrase = self.passphrase
-
-            cert = getEscrowCertificate(storage.escrowCertificates, self.escrowcert)
             if self.preexist:
-                luksformat = format
-                device.format = getFormat("luks", passphrase=self.passphrase, device=device.path,
-                                          cipher=self.cipher,
-                                          escrow_cert=cert,
-                                          add_backup_passphrase=self.backuppassphrase)
-                luksdev = LUKSDevice("luks%d" % storage.nextID,
-                                     format=luksformat,
-                                     parents=device)
+                _setupLUKS(storage, self, device, format, preexist=True)
             else:
-                luksformat = request.format
-                request.format = getFormat("luks", passphrase=self.passphrase,
-                                           cipher=self.cipher,
-                                           escrow_cert=cert,
-                                           add_backup_passphrase=self.backuppassphrase)
-                luksdev = LUKSDevice("luks%d" % storage.nextID,
-                                     format=luksformat,
-                                     parents=request)
-            storage.createDevice(luksdev)
+                _setupLUKS(storage, self, request, request.format, preexist=False)
 
 class Logging(commands.logging.FC6_Logging):
     def execute(self, *args):
@@ -928,30 +1225,71 @@ class DmRaid(commands.dmraid.FC6_DmRaid):
         raise NotImplementedError("The dmraid kickstart command is not currently supported")
 
 class Partition(commands.partition.F20_Partition):
+    def parse(self, args):
+        retval = commands.partition.F20_Partition.parse(self, args)
+        _checkMountpoint(retval.mountpoint, self.lineno)
+        return retval
+
     def execute(self, storage, ksdata, instClass):
+        _checkDuplicateMountpoints(self.partitions)
+
+        # reverse map of eddDict, keyed by the hex BIOS disk number.  It
+        # is scoped to this pass rather than cached on storage because
+        # blivet rebuilds eddDict on storage.reset.
+        eddIndex = None
+        if any(p.onbiosdisk != "" for p in self.partitions):
+            eddIndex = dict(("%x" % biosdisk, disk)
+                            for (disk, biosdisk) in storage.eddDict.iteritems())
+
+        # Report every bad part line in one go rather than making the
+        # user fix them one failed install at a time.
+        errors = []
         for p in self.partitions:
-            p.execute(storage, ksdata, instClass)
+            try:
+                p.execute(storage, ksdata, instClass, eddIndex=eddIndex)
+            except KickstartValueError as e:
+                errors.append(str(e))
+
+        if errors:
+            raise KickstartValueError("\n".join(errors))
 
         if self.partitions:
             doPartitioning(storage)
 
+# mountpoint keywords that really name a partition type, and the
+# container-member prefixes shared by the part and raid commands
+_PART_EXACT_TYPES = {"appleboot": "appleboot",
+                     "prepboot": "prepboot",
+                     "biosboot": "biosboot"}
+_PART_PREFIX_TYPES = (("raid.", "mdmember", "RAID"),
+                      ("pv.", "lvmpv", "PV"),
+                      ("btrfs.", "btrfs", "BTRFS"))
+# raid lines only accept the container-member forms
+_RAID_PREFIX_TYPES = _PART_PREFIX_TYPES[1:]
+
 class PartitionData(commands.partition.F18_PartData):
-    def execute(self, storage, ksdata, instClass):
+    def execute(self, storage, ksdata, instClass, eddIndex=None):
         devicetree = storage.devicetree
         kwargs = {}
 
         storage.doAutoPart = False
 
         if self.onbiosdisk != "":
-            for (disk, biosdisk) in storage.eddDict.iteritems():
-                if "%x" % biosdisk == self.onbiosdisk:
-                    self.disk = disk
-                    break
+            if eddIndex is None:
+                # not called through Partition.execute; build the map
+                # for this line alone
+                eddIndex = dict(("%x" % biosdisk, disk)
+                                for (disk, biosdisk) in storage.eddDict.iteritems())
+
+            disk = eddIndex.get(self.onbiosdisk)
+            if disk:
+                self.disk = disk
 
             if not self.disk:
-                raise KickstartValueError, formatErrorMsg(self.lineno, msg="Specified BIOS disk %s cannot be determined" % self.onbiosdisk)
+                _kickstartValueError(self.lineno, "Specified BIOS disk %s cannot be determined" % self.onbiosdisk)
 
-        if self.mountpoint == "swap":
+        mountpoint = self.mountpoint
+        if mountpoint == "swap":
             type = "swap"
             self.mountpoint = ""
             if self.recommended or self.hibernation:
@@ -960,74 +1298,60 @@ class PartitionData(commands.partition.F18_PartData):
                 self.grow = False
         # if people want to specify no mountpoint for some reason, let them
         # this is really needed for pSeries boot partitions :(
-        elif self.mountpoint == "None":
+        elif mountpoint == "None":
             self.mountpoint = ""
             if self.fstype:
                 type = self.fstype
             else:
                 type = storage.defaultFSType
-        elif self.mountpoint == 'appleboot':
-            type = "appleboot"
+        elif mountpoint in _PART_EXACT_TYPES:
+            type = _PART_EXACT_TYPES[mountpoint]
             self.mountpoint = ""
-        elif self.mountpoint == 'prepboot':
-            type = "prepboot"
-            self.mountpoint = ""
-        elif self.mountpoint == 'biosboot':
-            type = "biosboot"
-            self.mountpoint = ""
-        elif self.mountpoint.startswith("raid."):
-            type = "mdmember"
-            kwargs["name"] = self.mountpoint
-            self.mountpoint = ""
-
-            if devicetree.getDeviceByName(kwargs["name"]):
-                raise KickstartValueError, formatErrorMsg(self.lineno, msg="RAID partition defined multiple times")
-
-            if self.onPart:
-                ksdata.onPart[kwargs["name"]] = self.onPart
-        elif self.mountpoint.startswith("pv."):
-            type = "lvmpv"
-            kwargs["name"] = self.mountpoint
-            self.mountpoint = ""
-
-            if devicetree.getDeviceByName(kwargs["name"]):
-                raise KickstartValueError, formatErrorMsg(self.lineno, msg="PV partition defined multiple times")
-
-            if self.onPart:
-                ksdata.onPart[kwargs["name"]] = self.onPart
-        elif self.mountpoint.startswith("btrfs."):
-            type = "btrfs"
-            kwargs["name"] = self.mountpoint
-            self.mountpoint = ""
-
-            if devicetree.getDeviceByName(kwargs["name"]):
-                raise KickstartValueError, formatErrorMsg(self.lineno, msg="BTRFS partition defined multiple times")
-
-            if self.onPart:
-                ksdata.onPart[kwargs["name"]] = self.onPart
-        elif self.mountpoint == "/boot/efi":
+        elif mountpoint == "/boot/efi":
             if blivet.arch.isMactel():
                 type = "hfs+"
             else:
                 type = "EFI System Partition"
                 self.fsopts = "defaults,uid=0,gid=0,umask=0077,shortname=winnt"
         else:
-            if self.fstype != "":
-                type = self.fstype
-            elif self.mountpoint == "/boot":
-                type = storage.defaultBootFSType
+            for prefix, member_type, label in _PART_PREFIX_TYPES:
+                if not mountpoint.startswith(prefix):
+                    continue
+
+                type = member_type
+                kwargs["name"] = mountpoint
+                self.mountpoint = ""
+
+                if devicetree.getDeviceByName(kwargs["name"]):
+                    _kickstartValueError(self.lineno, "%s partition defined multiple times" % label)
+
+                if self.onPart:
+                    ksdata.onPart[kwargs["name"]] = self.onPart
+
+                break
             else:
-                type = storage.defaultFSType
+                if self.fstype != "":
+                    type = self.fstype
+                elif mountpoint == "/boot":
+                    type = storage.defaultBootFSType
+                else:
+                    type = storage.defaultFSType
+
+        # Resolve --onpart once; both the --noformat branch and the
+        # pre-existing partition branch below need it.
+        onpart_dev = None
+        if self.onPart:
+            onpart_dev = devicetree.resolveDevice(self.onPart)
 
         # If this specified an existing request that we should not format,
         # quit here after setting up enough information to mount it later.
         if not self.format:
             if not self.onPart:
-                raise KickstartValueError, formatErrorMsg(self.lineno, msg="--noformat used without --onpart")
+                _kickstartValueError(self.lineno, "--noformat used without --onpart")
 
-            dev = devicetree.resolveDevice(self.onPart)
+            dev = onpart_dev
             if not dev:
-                raise KickstartValueError, formatErrorMsg(self.lineno, msg="No preexisting partition with the name \"%s\" was found." % self.onPart)
+                _kickstartValueError(self.lineno, _NO_PREEXISTING_MSG % ("partition", _truncate(self.onPart)))
 
             if self.resize:
                 if self.size < dev.currentSize:
@@ -1036,21 +1360,26 @@ class PartitionData(commands.partition.F18_PartData):
                         devicetree.registerAction(ActionResizeFormat(dev, self.size))
                         devicetree.registerAction(ActionResizeDevice(dev, self.size))
                     except ValueError:
-                        raise KickstartValueError(formatErrorMsg(self.lineno,
-                                msg="Invalid target size (%d) for device %s" % (self.size, dev.name)))
+                        _kickstartValueError(self.lineno,
+                                _INVALID_TARGET_SIZE_MSG % (self.size, dev.name))
                 else:
                     # grow
                     try:
                         devicetree.registerAction(ActionResizeDevice(dev, self.size))
                         devicetree.registerAction(ActionResizeFormat(dev, self.size))
                     except ValueError:
-                        raise KickstartValueError(formatErrorMsg(self.lineno,
-                                msg="Invalid target size (%d) for device %s" % (self.size, dev.name)))
+                        _kickstartValueError(self.lineno,
+                                _INVALID_TARGET_SIZE_MSG % (self.size, dev.name))
 
             dev.format.mountpoint = self.mountpoint
             dev.format.mountopts = self.fsopts
             return
 
+        # Check that a pre-existing target partition is really there before
+        # building the format object, so a bad spec costs no allocation.
+        if self.onPart and not onpart_dev:
+            _kickstartValueError(self.lineno, "Specified nonexistent partition %s in partition command" % _truncate(self.onPart))
+
         # Now get a format to hold a lot of these extra values.
         kwargs["format"] = getFormat(type,
                                      mountpoint=self.mountpoint,
@@ -1059,7 +1388,7 @@ class PartitionData(commands.partition.F18_PartData):
                                      mountopts=self.fsopts,
                                      size=self.size)
         if not kwargs["format"].type:
-            raise KickstartValueError, formatErrorMsg(self.lineno, msg="The \"%s\" filesystem type is not supported." % type)
+            _kickstartValueError(self.lineno, _UNSUPPORTED_FSTYPE_MSG % type)
 
         # If we were given a specific disk to create the partition on, verify
         # that it exists first.  If it doesn't exist, see if it exists with
@@ -1068,23 +1397,21 @@ class PartitionData(commands.partition.F18_PartData):
             disk = devicetree.resolveDevice(self.disk)
             # if this is a multipath member promote it to the real mpath
             if disk and disk.format.type == "multipath_member":
-                mpath_device = storage.devicetree.getChildren(disk)[0]
-                storage_log.info("kickstart: part: promoting %s to %s"
-                                 % (disk.name, mpath_device.name))
+                mpath_device = devicetree.getChildren(disk)[0]
+                storage_log.info("kickstart: part: promoting %s to %s",
+                                 disk.name, mpath_device.name)
                 disk = mpath_device
             if not disk:
-                raise KickstartValueError, formatErrorMsg(self.lineno, msg="Specified nonexistent disk %s in partition command" % self.disk)
+                _kickstartValueError(self.lineno, "Specified nonexistent disk %s in partition command" % self.disk)
             if not disk.partitionable:
-                raise KickstartValueError, formatErrorMsg(self.lineno, msg="Cannot install to read-only media %s." % self.disk)
+                _kickstartValueError(self.lineno, "Cannot install to read-only media %s." % self.disk)
 
-            should_clear = storage.shouldClear(disk)
-            if disk and (disk.partitioned or should_clear):
+            # shouldClear walks the clearpart configuration, so only consult
+            # it when the disk is not already partitioned
+            if disk.partitioned or storage.shouldClear(disk):
                 kwargs["parents"] = [disk]
-            elif disk:
-                raise KickstartValueError, formatErrorMsg(self.lineno, msg="Specified unpartitioned disk %s in partition command" % self.disk)
-
-            if not kwargs["parents"]:
-                raise KickstartValueError, formatErrorMsg(self.lineno, msg="Specified nonexistent disk %s in partition command" % self.disk)
+            else:
+                _kickstartValueError(self.lineno, "Specified unpartitioned disk %s in partition command" % self.disk)
 
         kwargs["grow"] = self.grow
         kwargs["size"] = self.size
@@ -1092,21 +1419,17 @@ class PartitionData(commands.partition.F18_PartData):
         kwargs["primary"] = self.primOnly
 
         # If we were given a pre-existing partition to create a filesystem on,
-        # we need to verify it exists and then schedule a new format action to
-        # take place there.  Also, we only support a subset of all the options
-        # on pre-existing partitions.
+        # we schedule a new format action to take place there.  Also, we only
+        # support a subset of all the options on pre-existing partitions.
         if self.onPart:
-            device = devicetree.resolveDevice(self.onPart)
-            if not device:
-                raise KickstartValueError, formatErrorMsg(self.lineno, msg="Specified nonexistent partition %s in partition command" % self.onPart)
-
+            device = onpart_dev
             removeExistingFormat(device, storage)
             if self.resize:
                 try:
                     devicetree.registerAction(ActionResizeDevice(device, self.size))
                 except ValueError:
-                    raise KickstartValueError(formatErrorMsg(self.lineno,
-                            msg="Invalid target size (%d) for device %s" % (self.size, device.name)))
+                    _kickstartValueError(self.lineno,
+                            _INVALID_TARGET_SIZE_MSG % (self.size, device.name))
 
             devicetree.registerAction(ActionCreateFormat(device, kwargs["format"]))
         # tmpfs mounts are not disks and don't occupy a disk partition,
@@ -1117,129 +1440,134 @@ class PartitionData(commands.partition.F18_PartData):
         else:
             # If a previous device has claimed this mount point, delete the
             # old one.
-            try:
-                if self.mountpoint:
-                    device = storage.mountpoints[self.mountpoint]
-                    storage.destroyDevice(device)
-            except KeyError:
-                pass
+            _removeMountpointClaim(storage, None, self.mountpoint)
 
             request = storage.newPartition(**kwargs)
             storage.createDevice(request)
 
         if self.encrypted:
-            if self.passphrase and not storage.encryptionPassphrase:
-               storage.encryptionPassphrase = self.passphrase
-
-            cert = getEscrowCertificate(storage.escrowCertificates, self.escrowcert)
             if self.onPart:
-                luksformat = kwargs["format"]
-                device.format = getFormat("luks", passphrase=self.passphrase, device=device.path,
-                                          cipher=self.cipher,
-                                          escrow_cert=cert,
-                                          add_backup_passphrase=self.backuppassphrase)
-                luksdev = LUKSDevice("luks%d" % storage.nextID,
-                                     format=luksformat,
-                                     parents=device)
+                _setupLUKS(storage, self, device, kwargs["format"], preexist=True)
             else:
-                luksformat = request.format
-                request.format = getFormat("luks", passphrase=self.passphrase,
-                                           cipher=self.cipher,
-                                           escrow_cert=cert,
-                                           add_backup_passphrase=self.backuppassphrase)
-                luksdev = LUKSDevice("luks%d" % storage.nextID,
-                                     format=luksformat,
-                                     parents=request)
-            storage.createDevice(luksdev)
+                _setupLUKS(storage, self, request, request.format, preexist=False)
 
 class Raid(commands.raid.F19_Raid):
+    def parse(self, args):
+        retval = commands.raid.F19_Raid.parse(self, args)
+        _checkMountpoint(retval.mountpoint, self.lineno)
+        return retval
+
     def execute(self, storage, ksdata, instClass):
+        _checkDuplicateMountpoints(self.raidList)
+
+        # collect the existing array names once instead of rescanning
+        # storage.mdarrays for every raid line
+        mdNames = set(a.name for a in storage.mdarrays)
+        errors = []
         for r in self.raidList:
-            r.execute(storage, ksdata, instClass)
+            try:
+                r.execute(storage, ksdata, instClass, mdNames)
+            except KickstartValueError as e:
+                errors.append(str(e))
+
+        if errors:
+            raise KickstartValueError("\n".join(errors))
 
 class RaidData(commands.raid.F18_RaidData):
-    def execute(self, storage, ksdata, instClass):
+    def execute(self, storage, ksdata, instClass, mdNames=None):
         raidmems = []
         devicetree = storage.devicetree
         devicename = self.device
+
+        # Resolve the target array once; the --noformat and pre-existing
+        # branches below all want the same device.
+        raid_dev = None
         if self.preexist:
-            device = devicetree.resolveDevice(devicename)
-            if device:
-                devicename = device.name
+            raid_dev = devicetree.resolveDevice(devicename)
+            if raid_dev:
+                devicename = raid_dev.name
+        elif devicename and not self.format:
+            raid_dev = devicetree.getDeviceByName(devicename)
 
         kwargs = {}
 
         storage.doAutoPart = False
 
-        if self.mountpoint == "swap":
+        mountpoint = self.mountpoint
+        if mountpoint == "swap":
             type = "swap"
             self.mountpoint = ""
-        elif self.mountpoint.startswith("pv."):
-            type = "lvmpv"
-            kwargs["name"] = self.mountpoint
-            ksdata.onPart[kwargs["name"]] = devicename
+        else:
+            for prefix, member_type, label in _RAID_PREFIX_TYPES:
+                if not mountpoint.startswith(prefix):
+                    continue
 
-            if devicetree.getDeviceByName(kwargs["name"]):
-                raise KickstartValueError, formatErrorMsg(self.lineno, msg="PV partition defined multiple times")
+                type = member_type
+                kwargs["name"] = mountpoint
 
-            self.mountpoint = ""
-        elif self.mountpoint.startswith("btrfs."):
-            type = "btrfs"
-            kwargs["name"] = self.mountpoint
-            ksdata.onPart[kwargs["name"]] = devicename
+                if devicetree.getDeviceByName(kwargs["name"]):
+                    _kickstartValueError(self.lineno, "%s partition defined multiple times" % label)
 
-            if devicetree.getDeviceByName(kwargs["name"]):
-                raise KickstartValueError, formatErrorMsg(self.lineno, msg="BTRFS partition defined multiple times")
+                # only record a device mapping when --device was given
+                if devicename:
+                    ksdata.onPart[kwargs["name"]] = devicename
 
-            self.mountpoint = ""
-        else:
-            if self.fstype != "":
-                type = self.fstype
-            elif self.mountpoint == "/boot" and \
-                 "mdarray" in storage.bootloader.stage2_device_types:
-                type = storage.defaultBootFSType
+                self.mountpoint = ""
+                break
             else:
-                type = storage.defaultFSType
+                if self.fstype != "":
+                    type = self.fstype
+                elif mountpoint == "/boot" and \
+                     "mdarray" in storage.bootloader.stage2_device_types:
+                    type = storage.defaultBootFSType
+                else:
+                    type = storage.defaultFSType
 
         # Sanity check mountpoint
         if self.mountpoint != "" and self.mountpoint[0] != '/':
-            raise KickstartValueError, formatErrorMsg(self.lineno, msg="The mount point is not valid.")
+            _kickstartValueError(self.lineno, "The mount point is not valid.")
 
         # If this specifies an existing request that we should not format,
         # quit here after setting up enough information to mount it later.
         if not self.format:
             if not devicename:
-                raise KickstartValueError, formatErrorMsg(self.lineno, msg="--noformat used without --device")
+                _kickstartValueError(self.lineno, "--noformat used without --device")
 
-            dev = devicetree.getDeviceByName(devicename)
+            dev = raid_dev
             if not dev:
-                raise KickstartValueError, formatErrorMsg(self.lineno, msg="No preexisting RAID device with the name \"%s\" was found." % devicename)
+                _kickstartValueError(self.lineno, _NO_PREEXISTING_MSG % ("RAID device", _truncate(devicename)))
 
             dev.format.mountpoint = self.mountpoint
             dev.format.mountopts = self.fsopts
             return
 
         # Get a list of all the RAID members.
+        aliases = _reqNameIndex(devicetree)
+        childMap = None
         for member in self.members:
             dev = devicetree.resolveDevice(member)
             if not dev:
                 # if member is using --onpart, use original device
                 mem = ksdata.onPart.get(member, member)
-                dev = devicetree.resolveDevice(mem) or lookupAlias(devicetree, member)
+                dev = devicetree.resolveDevice(mem) or aliases.get(member)
             if dev and dev.format.type == "luks":
-                try:
-                    dev = devicetree.getChildren(dev)[0]
-                except IndexError:
-                    dev = None
+                if childMap is None:
+                    childMap = _firstChildMap(devicetree)
+                dev = childMap.get(dev.id)
 
             if dev and dev.format.type != "mdmember":
-                raise KickstartValueError, formatErrorMsg(self.lineno, msg="RAID member %s has incorrect format (%s)" % (member, dev.format.type))
+                _kickstartValueError(self.lineno, "RAID member %s has incorrect format (%s)" % (_truncate(member), dev.format.type))
 
             if not dev:
-                raise KickstartValueError, formatErrorMsg(self.lineno, msg="Tried to use undefined partition %s in RAID specification" % member)
+                _kickstartValueError(self.lineno, "Tried to use undefined partition %s in RAID specification" % _truncate(member))
 
             raidmems.append(dev)
 
+        # Check that a pre-existing array is really there before building
+        # the format object, so a bad name costs no allocation.
+        if self.preexist and not raid_dev:
+            _kickstartValueError(self.lineno, "Specifeid nonexistent RAID %s in raid command" % _truncate(devicename))
+
         # Now get a format to hold a lot of these extra values.
         kwargs["format"] = getFormat(type,
                                      label=self.label,
@@ -1247,7 +1575,7 @@ class RaidData(commands.raid.F18_RaidData):
                                      mountpoint=self.mountpoint,
                                      mountopts=self.fsopts)
         if not kwargs["format"].type:
-            raise KickstartValueError, formatErrorMsg(self.lineno, msg="The \"%s\" filesystem type is not supported." % type)
+            _kickstartValueError(self.lineno, _UNSUPPORTED_FSTYPE_MSG % type)
 
         kwargs["name"] = devicename
         kwargs["level"] = self.level
@@ -1256,60 +1584,36 @@ class RaidData(commands.raid.F18_RaidData):
         kwargs["totalDevices"] = len(raidmems)
 
         # If we were given a pre-existing RAID to create a filesystem on,
-        # we need to verify it exists and then schedule a new format action
-        # to take place there.  Also, we only support a subset of all the
-        # options on pre-existing RAIDs.
+        # we schedule a new format action to take place there.  Also, we
+        # only support a subset of all the options on pre-existing RAIDs.
         if self.preexist:
-            device = devicetree.getDeviceByName(devicename)
-            if not device:
-                raise KickstartValueError, formatErrorMsg(self.lineno, msg="Specifeid nonexistent RAID %s in raid command" % devicename)
-
+            device = raid_dev
             removeExistingFormat(device, storage)
             devicetree.registerAction(ActionCreateFormat(device, kwargs["format"]))
         else:
-            if devicename and devicename in (a.name for a in storage.mdarrays):
-                raise KickstartValueError(formatErrorMsg(self.lineno, msg="The Software RAID array name \"%s\" is already in use." % devicename))
+            if mdNames is None:
+                mdNames = set(a.name for a in storage.mdarrays)
+
+            if devicename and devicename in mdNames:
+                _kickstartValueError(self.lineno, "The Software RAID array name \"%s\" is already in use." % devicename)
 
             # If a previous device has claimed this mount point, delete the
             # old one.
-            try:
-                if self.mountpoint:
-                    device = storage.mountpoints[self.mountpoint]
-                    storage.destroyDevice(device)
-            except KeyError:
-                pass
+            _removeMountpointClaim(storage, None, self.mountpoint)
 
             try:
                 request = storage.newMDArray(**kwargs)
             except ValueError as e:
-                raise KickstartValueError, formatErrorMsg(self.lineno, msg=str(e))
+                _kickstartValueError(self.lineno, str(e))
 
             storage.createDevice(request)
+            mdNames.add(request.name)
 
         if self.encrypted:
-            if self.passphrase and not storage.encryptionPassphrase:
-               storage.encryptionPassphrase = self.passphrase
-
-            cert = getEscrowCertificate(storage.escrowCertificates, self.escrowcert)
             if self.preexist:
-                luksformat = kwargs["format"]
-                device.format = getFormat("luks", passphrase=self.passphrase, device=device.path,
-                                          cipher=self.cipher,
-                                          escrow_cert=cert,
-                                          add_backup_passphrase=self.backuppassphrase)
-                luksdev = LUKSDevice("luks%d" % storage.nextID,
-                                     format=luksformat,
-                                     parents=device)
+                _setupLUKS(storage, self, device, kwargs["format"], preexist=True)
             else:
-                luksformat = request.format
-                request.format = getFormat("luks", passphrase=self.passphrase,
-                                           cipher=self.cipher,
-                                           escrow_cert=cert,
-                                           add_backup_passphrase=self.backuppassphrase)
-                luksdev = LUKSDevice("luks%d" % storage.nextID,
-                                     format=luksformat,
-                                     parents=request)
-            storage.createDevice(luksdev)
+                _setupLUKS(storage, self, request, request.format, preexist=False)
 
 class RepoData(commands.repo.F15_RepoData):
     def __init__(self, *args, **kwargs):
@@ -1338,7 +1642,7 @@ class SELinux(commands.selinux.FC3_SELinux):
                            SELINUX_PERMISSIVE: "permissive" }
 
         if self.selinux not in selinux_states:
-            log.error("unknown selinux state: %s" % (self.selinux,))
+            log.error("unknown selinux state: %s", self.selinux)
             return
 
         try:
@@ -1347,12 +1651,12 @@ class SELinux(commands.selinux.FC3_SELinux):
             selinux_cfg.set(("SELINUX", selinux_states[self.selinux]))
             selinux_cfg.write()
         except IOError as msg:
-            log.error ("Error setting selinux mode: %s" % (msg,))
+            log.error("Error setting selinux mode: %s", msg)
 
 class Services(commands.services.FC6_Services):
     def execute(self, storage, ksdata, instClass):
-        disabled = map(lambda s: s + ".service", self.disabled)
-        enabled = map(lambda s: s + ".service", self.enabled)
+        disabled = [s + ".service" for s in self.disabled]
+        enabled = [s + ".service" for s in self.enabled]
 
         if disabled:
             iutil.execWithRedirect("systemctl", ["disable"] + disabled,
@@ -1370,6 +1674,9 @@ class Timezone(commands.timezone.F18_Timezone):
         self._enabled_chrony = False
 
     def setup(self, ksdata):
+        packages = ksdata.packages.packageList
+        enabled = ksdata.services.enabled
+
         if self.nontp:
             if iutil.service_running(NTP_SERVICE) and \
                     flags_module.can_touch_runtime_system("stop NTP service"):
@@ -1377,12 +1684,13 @@ class Timezone(commands.timezone.F18_Timezone):
                 if ret != 0:
                     log.error("Failed to stop NTP service")
 
-            if self._added_chrony and NTP_PACKAGE in ksdata.packages.packageList:
-                ksdata.packages.packageList.remove(NTP_PACKAGE)
+            # only scan the package list if we were the ones who added it
+            if self._added_chrony and NTP_PACKAGE in packages:
+                packages.remove(NTP_PACKAGE)
                 self._added_chrony = False
 
-            if self._enabled_chrony and NTP_SERVICE in ksdata.services.enabled:
-                ksdata.services.enabled.remove(NTP_SERVICE)
+            if self._enabled_chrony and NTP_SERVICE in enabled:
+                enabled.remove(NTP_SERVICE)
                 self._enabled_chrony = False
 
         else:
@@ -1392,21 +1700,21 @@ class Timezone(commands.timezone.F18_Timezone):
                 if ret != 0:
                     log.error("Failed to start NTP service")
 
-            if not NTP_PACKAGE in ksdata.packages.packageList:
-                ksdata.packages.packageList.append(NTP_PACKAGE)
+            if NTP_PACKAGE not in packages:
+                packages.append(NTP_PACKAGE)
                 self._added_chrony = True
 
-            if not NTP_SERVICE in ksdata.services.enabled and \
-                    not NTP_SERVICE in ksdata.services.disabled:
-                ksdata.services.enabled.append(NTP_SERVICE)
+            if NTP_SERVICE not in enabled and \
+                    NTP_SERVICE not in ksdata.services.disabled:
+                enabled.append(NTP_SERVICE)
                 self._enabled_chrony = True
 
     def execute(self, *args):
         # write out timezone configuration
         if not timezone.is_valid_timezone(self.timezone):
             # this should never happen, but for pity's sake
-            log.warning("Timezone %s set in kickstart is not valid, falling "\
-                        "back to default (America/New_York)." % (self.timezone,))
+            log.warning("Timezone %s set in kickstart is not valid, falling "
+                        "back to default (America/New_York).", self.timezone)
             self.timezone = "America/New_York"
 
         timezone.write_timezone_config(self, iutil.getSysroot())
@@ -1418,7 +1726,7 @@ class Timezone(commands.timezone.F18_Timezone):
                 ntp.save_servers_to_config(self.ntpservers,
                                            conf_file_path=chronyd_conf_path)
             except ntp.NTPconfigError as ntperr:
-                log.warning("Failed to save NTP configuration: %s" % ntperr)
+                log.warning("Failed to save NTP configuration: %s", ntperr)
 
 class User(commands.user.F12_User):
     def execute(self, storage, ksdata, instClass, users):
@@ -1434,13 +1742,26 @@ class User(commands.user.F12_User):
             if ksdata.user.seen and kwargs.get("password", "") == "":
                 kwargs["password"] = None
             if not users.createUser(usr.name, **kwargs):
-                log.error("User %s already exists, not creating." % usr.name)
+                log.error("User %s already exists, not creating.", usr.name)
 
 class VolGroup(commands.volgroup.FC16_VolGroup):
     def execute(self, storage, ksdata, instClass):
         for v in self.vgList:
             v.execute(storage, ksdata, instClass)
 
+# The possible physical extent sizes depend only on the floor value, so
+# compute each answer once and keep it as a frozenset for O(1) membership
+# instead of rebuilding the list for every volgroup line.
+_validPESizes = {}
+
+def _validPESizesFor(floor):
+    sizes = _validPESizes.get(floor)
+    if sizes is None:
+        sizes = frozenset(getPossiblePhysicalExtents(floor=floor))
+        _validPESizes[floor] = sizes
+
+    return sizes
+
 class VolGroupData(commands.volgroup.FC16_VolGroupData):
     def execute(self, storage, ksdata, instClass):
         pvs = []
@@ -1450,42 +1771,51 @@ class VolGroupData(commands.volgroup.FC16_VolGroupData):
         storage.doAutoPart = False
 
         # Get a list of all the physical volume devices that make up this VG.
+        index = _deviceIndex(devicetree)
+        aliases = _reqNameIndex(devicetree)
+        childMap = None
+        # bind the per-iteration lookups to locals; with many PVs the
+        # repeated attribute resolution is measurable
+        onPart = ksdata.onPart
+        lookup = index.get
+        resolve = devicetree.resolveDevice
         for pv in self.physvols:
-            dev = devicetree.resolveDevice(pv)
+            # if pv is using --onpart, use original device
+            pv_name = onPart.get(pv, pv)
+            dev = lookup(pv) or lookup(pv_name)
             if not dev:
-                # if pv is using --onpart, use original device
-                pv_name = ksdata.onPart.get(pv, pv)
-                dev = devicetree.resolveDevice(pv_name) or lookupAlias(devicetree, pv)
+                # the spec may be a form the index does not cover (e.g. a
+                # symlink or LABEL=); fall back to full resolution
+                dev = resolve(pv) or resolve(pv_name) or aliases.get(pv)
             if dev and dev.format.type == "luks":
-                try:
-                    dev = devicetree.getChildren(dev)[0]
-                except IndexError:
-                    dev = None
+                if childMap is None:
+                    childMap = _firstChildMap(devicetree)
+                dev = childMap.get(dev.id)
 
             if dev and dev.format.type != "lvmpv":
-                raise KickstartValueError, formatErrorMsg(self.lineno, msg="Physical Volume %s has incorrect format (%s)" % (pv, dev.format.type))
+                _kickstartValueError(self.lineno, "Physical Volume %s has incorrect format (%s)" % (_truncate(pv), dev.format.type))
 
             if not dev:
-                raise KickstartValueError, formatErrorMsg(self.lineno, msg="Tried to use undefined partition %s in Volume Group specification" % pv)
+                _kickstartValueError(self.lineno, "Tried to use undefined partition %s in Volume Group specification" % _truncate(pv))
 
             pvs.append(dev)
 
         if len(pvs) == 0 and not self.preexist:
-            raise KickstartValueError, formatErrorMsg(self.lineno, msg="Volume group defined without any physical volumes.  Either specify physical volumes or use --useexisting.")
+            _kickstartValueError(self.lineno, "Volume group defined without any physical volumes.  Either specify physical volumes or use --useexisting.")
 
-        if self.pesize not in getPossiblePhysicalExtents(floor=1024):
-            raise KickstartValueError, formatErrorMsg(self.lineno, msg="Volume group specified invalid pesize")
+        if self.pesize not in _validPESizesFor(1024):
+            _kickstartValueError(self.lineno, "Volume group specified invalid pesize")
 
         # If --noformat or --useexisting was given, there's really nothing to do.
         if not self.format or self.preexist:
             if not self.vgname:
-                raise KickstartValueError, formatErrorMsg(self.lineno, msg="--noformat or --useexisting used without giving a name")
+                _kickstartValueError(self.lineno, "--noformat or --useexisting used without giving a name")
 
-            dev = devicetree.getDeviceByName(self.vgname)
+            dev = index.get(self.vgname)
             if not dev:
-                raise KickstartValueError, formatErrorMsg(self.lineno, msg="No preexisting VG with the name \"%s\" was found." % self.vgname)
+                _kickstartValueError(self.lineno, _NO_PREEXISTING_MSG % ("VG", _truncate(self.vgname)))
         elif self.vgname in (vg.name for vg in storage.vgs):
-            raise KickstartValueError(formatErrorMsg(self.lineno, msg="The volume group name \"%s\" is already in use." % self.vgname))
+            _kickstartValueError(self.lineno, "The volume group name \"%s\" is already in use." % _truncate(self.vgname))
         else:
             request = storage.newVG(parents=pvs,
                                     name=self.vgname,
@@ -1524,6 +1854,9 @@ class ZFCP(commands.zfcp.F14_ZFCP):
         fcp = commands.zfcp.F14_ZFCP.parse(self, args)
         try:
             blivet.zfcp.ZFCP().addFCP(fcp.devnum, fcp.wwpn, fcp.fcplun)
+            # a new LUN means new block devices the cached udev snapshot
+            # does not know about
+            _clearDeviceMatchCache()
         except ValueError as e:
             log.warning(str(e))
 
@@ -1544,14 +1877,30 @@ class Upgrade(commands.upgrade.F20_Upgrade):
         sys.stderr.write(_("The upgrade kickstart command is no longer supported. Upgrade functionality is provided through redhat-upgrade-tool."))
         sys.exit(1)
 
-class SpokeRegistry(dict):
+class SpokeRegistry(object):
     """This class represents the ksdata.firstboot object and
        maintains the ids of all user configured spokes.
 
        The information is then used by inital_setup and GIE
        to hide already configured spokes.
+
+       It is an append-only log, so a slotted object holding a plain
+       list of (spoke, value) pairs is leaner than the dict subclass it
+       used to be; the dict-style __setitem__/iteritems interface is
+       kept for the external consumers.
     """
 
+    __slots__ = ("_entries",)
+
+    def __init__(self):
+        self._entries = []
+
+    def __setitem__(self, key, value):
+        self._entries.append((key, value))
+
+    def iteritems(self):
+        return iter(self._entries)
+
     def __str__(self):
         # do not write anything into kickstart
         return ""
@@ -1563,10 +1912,12 @@ class SpokeRegistry(dict):
             os.makedirs(path, 0755)
         except OSError:
             pass
-        f = open(os.path.join(path, "configured.ini"), "a")
-        for k,v in self.iteritems():
-            f.write("%s=%s\n" % (k, v))
-        f.close()
+
+        # build the whole payload first so the file sees a single write
+        # instead of one buffered-IO call per spoke
+        payload = "".join("%s=%s\n" % kv for kv in self.iteritems())
+        with open(os.path.join(path, "configured.ini"), "a") as f:
+            f.write(payload)
 
 ###
 ### HANDLERS
@@ -1623,36 +1974,92 @@ dataMap = {
 }
 
 superclass = returnClassForVersion(RHEL7)
-    
+
+class _LazyAddonRegistry(AddonRegistry):
+    """ An AddonRegistry that imports an addon's kickstart module the
+        first time its id is referenced by an %addon section, instead of
+        importing every installed addon when the handler is built.
+
+        The bookkeeping lives in the shared namespace under underscored
+        keys, so the iteration-based methods skip those to keep them out
+        of addon dispatch and kickstart output.
+    """
+
+    def __init__(self, addon_module_paths, addon_class_type):
+        AddonRegistry.__init__(self, {"_paths": dict(addon_module_paths),
+                                      "_class_type": addon_class_type})
+
+    def __getattr__(self, name):
+        # only called when normal attribute lookup misses
+        entry = self.__dict__["_paths"].pop(name, None)
+        if entry is None:
+            raise AttributeError(name)
+
+        module_name, path = entry
+        class_type = self.__dict__["_class_type"]
+        classes = collect(module_name, path,
+                          lambda cls: issubclass(cls, class_type))
+        if not classes:
+            raise AttributeError(name)
+
+        addon = classes[0](name=name)
+        setattr(self, name, addon)
+        return addon
+
+    # pylint: disable-msg=C0103
+    def execute(self, storage, ksdata, instClass, users):
+        for k, v in self.__dict__.iteritems():
+            if not k.startswith("_") and hasattr(v, "execute"):
+                v.execute(storage, ksdata, instClass, users)
+
+    def setup(self, storage, ksdata, instClass):
+        for k, v in self.__dict__.iteritems():
+            if not k.startswith("_") and hasattr(v, "setup"):
+                v.setup(storage, ksdata, instClass)
+
+    def __str__(self):
+        return "".join(str(addon) for k, addon in self.__dict__.iteritems()
+                       if not k.startswith("_"))
+
+class _BucketedScriptList(list):
+    # handler.scripts, with a per-type bucket maintained as the sections
+    # append their scripts so the run*Scripts runners do not each rescan
+    # the whole list
+    def __init__(self, iterable=()):
+        list.__init__(self, iterable)
+        self.by_type = {}
+        for script in self:
+            self.by_type.setdefault(script.type, []).append(script)
+
+    def append(self, script):
+        list.append(self, script)
+        self.by_type.setdefault(script.type, []).append(script)
+
 class AnacondaKSHandler(superclass):
     AddonClassType = AddonData
-    
+
     def __init__ (self, addon_paths = [], commandUpdates=commandMap, dataUpdates=dataMap):
         superclass.__init__(self, commandUpdates=commandUpdates, dataUpdates=dataUpdates)
         self.onPart = {}
+        self.scripts = _BucketedScriptList(self.scripts)
 
-        # collect all kickstart addons for anaconda to addons dictionary
-        # which maps addon_id to it's own data structure based on BaseData
-        # with execute method
-        addons = {}
-
-        # collect all AddonData subclasses from
+        # map addon ids to the location of their kickstart module:
         # for p in addon_paths: <p>/<plugin id>/ks/*.(py|so)
-        # and register them under <plugin id> name
+        # The modules themselves are imported lazily, when an %addon
+        # section first references the id.
+        addon_module_paths = {}
         for module_name, path in addon_paths:
             addon_id = os.path.basename(os.path.dirname(os.path.abspath(path)))
             if not os.path.isdir(path):
                 continue
 
-            classes = collect(module_name, path, lambda cls: issubclass(cls, self.AddonClassType))
-            if classes:
-                addons[addon_id] = classes[0](name = addon_id)
+            addon_module_paths[addon_id] = (module_name, path)
 
         # Prepare the structure to track configured spokes
         self.configured_spokes = SpokeRegistry()
 
         # Prepare the final structures for 3rd party addons
-        self.addons = AddonRegistry(addons)
+        self.addons = _LazyAddonRegistry(addon_module_paths, self.AddonClassType)
 
     def __str__(self):
         return superclass.__str__(self) + "\n" +  str(self.addons)
@@ -1660,6 +2067,15 @@ class AnacondaKSHandler(superclass):
 class AnacondaPreParser(KickstartParser):
     # A subclass of KickstartParser that only looks for %pre scripts and
     # sets them up to be run.  All other scripts and commands are ignored.
+    # Missing includes must not be fatal here: the canonical layout puts
+    # an %include in the command section and the %pre that generates the
+    # included file at the bottom, so the file does not exist until this
+    # pass has run the script.
+    #
+    # A raw regex scan for %pre ... %end blocks would avoid feeding the
+    # bulk of the file (%packages, %post) through the parser line by
+    # line, but only the real parser resolves %include, and a %pre may
+    # live inside an included file - so the NullSections stay.
     def __init__ (self, handler, followIncludes=True, errorsAreFatal=True,
                   missingIncludeIsFatal=True):
         KickstartParser.__init__(self, handler, missingIncludeIsFatal=False)
@@ -1673,20 +2089,13 @@ class AnacondaPreParser(KickstartParser):
         self.registerSection(NullSection(self.handler, sectionOpen="%traceback"))
         self.registerSection(NullSection(self.handler, sectionOpen="%packages"))
         self.registerSection(NullSection(self.handler, sectionOpen="%addon"))
-        
-    
+
 class AnacondaKSParser(KickstartParser):
     def __init__ (self, handler, followIncludes=True, errorsAreFatal=True,
                   missingIncludeIsFatal=True, scriptClass=AnacondaKSScript):
         self.scriptClass = scriptClass
         KickstartParser.__init__(self, handler)
 
-    def handleCommand (self, lineno, args):
-        if not self.handler:
-            return
-
-        return KickstartParser.handleCommand(self, lineno, args)
-
     def setupSections(self):
         self.registerSection(PreScriptSection(self.handler, dataObj=self.scriptClass))
         self.registerSection(PostScriptSection(self.handler, dataObj=self.scriptClass))
@@ -1694,19 +2103,40 @@ class AnacondaKSParser(KickstartParser):
         self.registerSection(PackageSection(self.handler))
         self.registerSection(AddonSection(self.handler))
 
+# The pre-pass parser never dispatches commands, so a single bare handler
+# can satisfy the parser API for every preScriptPass call.  Building an
+# AnacondaKSHandler makes pykickstart instantiate and register every
+# command class, which is not worth repeating for a pass that ignores
+# them all.
+_preScriptHandler = None
+
+def _getPreScriptHandler():
+    global _preScriptHandler
+    if _preScriptHandler is None:
+        _preScriptHandler = AnacondaKSHandler()
+
+    # scripts collected by a previous pass must not leak into this one;
+    # replace the list outright so the per-type buckets reset with it
+    _preScriptHandler.scripts = _BucketedScriptList()
+    return _preScriptHandler
+
+def _readKickstart(ksparser, f):
+    # Read the kickstart, treating parse errors as fatal.  This runs
+    # before any interface is up, so we cannot use our error handling
+    # callback.
+    try:
+        ksparser.readKickstart(f)
+    except KickstartError as e:
+        sys.stderr.write("%s\n" % e)
+        sys.exit(1)
+
 def preScriptPass(f):
     # The first pass through kickstart file processing - look for %pre scripts
     # and run them.  This must come in a separate pass in case a script
     # generates an included file that has commands for later.
-    ksparser = AnacondaPreParser(AnacondaKSHandler())
+    ksparser = AnacondaPreParser(_getPreScriptHandler())
 
-    try:
-        ksparser.readKickstart(f)
-    except KickstartError as e:
-        # We do not have an interface here yet, so we cannot use our error
-        # handling callback.
-        print e
-        sys.exit(1)
+    _readKickstart(ksparser, f)
 
     # run %pre scripts
     runPreScripts(ksparser.handler.scripts)
@@ -1718,33 +2148,50 @@ def parseKickstart(f):
     handler = AnacondaKSHandler(addon_paths["ks"])
     ksparser = AnacondaKSParser(handler)
 
-    # We need this so all the /dev/disk/* stuff is set up before parsing.
-    udev.udev_trigger(subsystem="block", action="change")
-    # So that drives onlined by these can be used in the ks file
-    blivet.iscsi.iscsi().startup()
-    blivet.fcoe.fcoe().startup()
-    blivet.zfcp.ZFCP().startup()
+    # We need this so all the /dev/disk/* stuff is set up before parsing,
+    # and so that drives onlined by iscsi/fcoe/zfcp can be used in the ks
+    # file.  The four startups touch disjoint subsystems and are mostly
+    # waiting on the kernel, so run them in parallel through the thread
+    # manager; waiting on each re-raises any exception here, matching
+    # the old sequential calls instead of dying silently on a thread.
+    # threadMgr is only created by initThreading, so import it late
+    from pyanaconda.threads import threadMgr, AnacondaThread
+    task_names = [
+        threadMgr.add(AnacondaThread(name=THREAD_KS_UDEV_TRIGGER, fatal=False,
+                                     target=udev.udev_trigger,
+                                     kwargs={"subsystem": "block", "action": "change"})),
+        threadMgr.add(AnacondaThread(name=THREAD_KS_ISCSI_STARTUP, fatal=False,
+                                     target=blivet.iscsi.iscsi().startup)),
+        threadMgr.add(AnacondaThread(name=THREAD_KS_FCOE_STARTUP, fatal=False,
+                                     target=blivet.fcoe.fcoe().startup)),
+        threadMgr.add(AnacondaThread(name=THREAD_KS_ZFCP_STARTUP, fatal=False,
+                                     target=blivet.zfcp.ZFCP().startup))]
+    for name in task_names:
+        threadMgr.wait(name)
     # Note we do NOT call dasd.startup() here, that does not online drives, but
     # only checks if they need formatting, which requires zerombr to be known
 
-    try:
-        ksparser.readKickstart(f)
-    except KickstartError as e:
-        # We do not have an interface here yet, so we cannot use our error
-        # handling callback.
-        print e
-        sys.exit(1)
+    _readKickstart(ksparser, f)
 
     return handler
 
 def appendPostScripts(ksdata):
-    scripts = ""
+    # Read in all the post script snippets to a single big string.  One
+    # listdir instead of the glob stat-per-pattern dance, and a join at
+    # the end instead of growing the string quadratically.
+    snippet_dir = "/usr/share/anaconda/post-scripts"
+    try:
+        names = os.listdir(snippet_dir)
+    except OSError:
+        names = []
 
-    # Read in all the post script snippets to a single big string.
-    for fn in glob.glob("/usr/share/anaconda/post-scripts/*ks"):
-        f = open(fn, "r")
-        scripts += f.read()
-        f.close()
+    parts = []
+    for fn in names:
+        if fn.endswith("ks"):
+            with open(os.path.join(snippet_dir, fn), "r") as f:
+                parts.append(f.read())
+
+    scripts = "".join(parts)
 
     # Then parse the snippets against the existing ksdata.  We can do this
     # because pykickstart allows multiple parses to save their data into a
@@ -1753,23 +2200,36 @@ def appendPostScripts(ksdata):
     ksparser = AnacondaKSParser(ksdata, scriptClass=AnacondaInternalScript)
     ksparser.readKickstartFromString(scripts, reset=False)
 
+def _scriptsOfType(scripts, script_type):
+    # a list rather than a generator: the runners check for emptiness
+    # before emitting their log banners
+    buckets = getattr(scripts, "by_type", None)
+    if buckets is not None:
+        return buckets.get(script_type, [])
+
+    # plain list (e.g. a stock pykickstart handler); fall back to a scan
+    return [s for s in scripts if s.type == script_type]
+
+# Environment variables that cause problems for %post scripts.
+_POST_ENV_STRIP = ("LIBUSER_CONF",)
+
 def runPostScripts(scripts):
-    postScripts = filter (lambda s: s.type == KS_SCRIPT_POST, scripts)
+    postScripts = _scriptsOfType(scripts, KS_SCRIPT_POST)
 
     if len(postScripts) == 0:
         return
 
-    # Remove environment variables that cause problems for %post scripts.
-    for var in ["LIBUSER_CONF"]:
-        if os.environ.has_key(var):
-            del(os.environ[var])
+    for var in _POST_ENV_STRIP:
+        os.environ.pop(var, None)
 
     log.info("Running kickstart %%post script(s)")
-    map (lambda s: s.run(iutil.getSysroot()), postScripts)
+    sysroot = iutil.getSysroot()
+    for script in postScripts:
+        script.run(sysroot)
     log.info("All kickstart %%post script(s) have been run")
 
 def runPreScripts(scripts):
-    preScripts = filter (lambda s: s.type == KS_SCRIPT_PRE, scripts)
+    preScripts = _scriptsOfType(scripts, KS_SCRIPT_PRE)
 
     if len(preScripts) == 0:
         return
@@ -1777,21 +2237,27 @@ def runPreScripts(scripts):
     log.info("Running kickstart %%pre script(s)")
     stdoutLog.info(_("Running pre-installation scripts"))
 
-    map (lambda s: s.run("/"), preScripts)
+    for script in preScripts:
+        script.run("/")
 
     log.info("All kickstart %%pre script(s) have been run")
 
 def runTracebackScripts(scripts):
     log.info("Running kickstart %%traceback script(s)")
-    for script in filter (lambda s: s.type == KS_SCRIPT_TRACEBACK, scripts):
+    for script in _scriptsOfType(scripts, KS_SCRIPT_TRACEBACK):
         script.run("/")
     log.info("All kickstart %%traceback script(s) have been run")
 
 def doKickstartStorage(storage, ksdata, instClass):
     """ Setup storage state from the kickstart data """
+    # Specs resolved at parse time may be stale by now (hotplug), so make
+    # the execute phase re-resolve them.
+    _clearDeviceMatchCache()
     ksdata.clearpart.execute(storage, ksdata, instClass)
-    if not any(d for d in storage.disks
-               if not d.format.hidden and not d.protected):
+    # bind the property result once; the generator yields booleans so
+    # any() can short-circuit without binding each device
+    disks = storage.disks
+    if not any((not d.format.hidden) and (not d.protected) for d in disks):
         return
     ksdata.bootloader.execute(storage, ksdata, instClass)
     ksdata.autopart.execute(storage, ksdata, instClass)
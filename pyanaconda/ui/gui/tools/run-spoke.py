@@ -11,7 +11,6 @@ for p in os.environ.get("ANACONDA_WIDGETS_OVERRIDES", "").split(":"):
 
 from gi.repository import AnacondaWidgets, Gtk
 
-import ctypes
 import os.path
 
 # Check command line arguments
@@ -19,9 +18,6 @@ if len(sys.argv)<2:
     print "Usage: $0 <spoke module name> [<spoke widget class>]"
     sys.exit(1)
 
-# This is a hack to make sure the AnacondaWidgets library gets loaded
-ctypes.CDLL("libAnacondaWidgets.so.0", ctypes.RTLD_GLOBAL)
-
 # Logging always needs to be set up first thing, or there'll be tracebacks.
 from pyanaconda import anaconda_log
 anaconda_log.init()